@@ -5,11 +5,12 @@ Source: https://www.statcan.gc.ca/en/lode/databases/odef
 CRS: EPSG:3347 (Statistics Canada Lambert) - Equal-area projection in meters for Canada
 """
 
-import pandas as pd
+import pyarrow.csv as pv
 import geopandas as gpd
-from shapely.geometry import Point
+import pyogrio
 from pathlib import Path
 import numpy as np
+from census_cache import write_census_parquet
 
 # Target CRS for Canada
 TARGET_EPSG = 3347
@@ -25,30 +26,33 @@ print("=" * 60)
 # ============================================================================
 print("\n[PART 1] Loading and filtering school data...")
 
-can_df = pd.read_csv('schools/canada/odef_v2/ODEF_v2_1.csv', encoding='latin1')
-
-# Convert ISCED columns to numeric (they're read as strings)
+# Parse, type and null-handle the ISCED and coordinate columns in one pass
+# ('..' and '...' are the ODEF placeholders for missing values)
 isced_cols = ['ISCED010', 'ISCED020', 'ISCED1', 'ISCED2', 'ISCED3', 'ISCED4Plus']
-for col in isced_cols:
-    can_df[col] = pd.to_numeric(can_df[col], errors='coerce')
+column_types = {col: 'float32' for col in isced_cols}
+column_types.update({'Latitude': 'float64', 'Longitude': 'float64'})
+
+tbl = pv.read_csv(
+    'schools/canada/odef_v2/ODEF_v2_1.csv',
+    read_options=pv.ReadOptions(encoding='latin1'),
+    convert_options=pv.ConvertOptions(column_types=column_types, null_values=['..', '...', '', 'NA']),
+)
+can_df = tbl.to_pandas()
+
+# ISCED flags are 0/1; store as int8 with -1 for missing so the filter below is one pass over a small buffer
+can_df[isced_cols] = can_df[isced_cols].fillna(-1).astype('int8')
 
 print(f"Total dataset length: {len(can_df)}")
 print(f"Post-secondary records (ISCED4Plus == 1): {(can_df['ISCED4Plus'] == 1).sum()}")
 
 # Only drop rows where ISCED4Plus is 1 AND all other ISCED levels are 0
-exclusively_post_secondary = (
-    (can_df['ISCED4Plus'] == 1) &
-    (can_df['ISCED010'] == 0) &
-    (can_df['ISCED020'] == 0) &
-    (can_df['ISCED1'] == 0) &
-    (can_df['ISCED2'] == 0) &
-    (can_df['ISCED3'] == 0)
-)
+isced = can_df[isced_cols].to_numpy()
+exclusively_post_secondary = (isced[:, 5] == 1) & (isced[:, :5] == 0).all(axis=1)
 
 print(f"Exclusively post-secondary records: {exclusively_post_secondary.sum()}")
 
 # Drop exclusively post-secondary facilities
-can_df = can_df[~exclusively_post_secondary]
+can_df = can_df.iloc[~exclusively_post_secondary]
 
 print(f"Records after filtering: {len(can_df)}")
 print(f"Facility types remaining: {len(can_df['Facility_Type'].unique())} unique types")
@@ -58,11 +62,6 @@ print(f"Facility types remaining: {len(can_df['Facility_Type'].unique())} unique
 # ============================================================================
 print("\n[PART 2] Creating point geometries from coordinates...")
 
-# Convert coordinate columns to numeric (handles '..' and other invalid values)
-print(f"Converting coordinate columns to numeric...")
-can_df['Latitude'] = pd.to_numeric(can_df['Latitude'], errors='coerce')
-can_df['Longitude'] = pd.to_numeric(can_df['Longitude'], errors='coerce')
-
 # Check for invalid coordinates
 invalid_coords = can_df['Latitude'].isna() | can_df['Longitude'].isna()
 print(f"Records with invalid coordinates: {invalid_coords.sum()}")
@@ -77,7 +76,7 @@ if len(can_df) == 0:
     exit(1)
 
 # Create geometry column from Latitude/Longitude (WGS84)
-geometry = [Point(xy) for xy in zip(can_df['Longitude'], can_df['Latitude'])]
+geometry = gpd.points_from_xy(can_df['Longitude'].to_numpy(), can_df['Latitude'].to_numpy())
 schools_gdf = gpd.GeoDataFrame(can_df, geometry=geometry, crs='EPSG:4326')
 
 print(f"Created {len(schools_gdf)} school points")
@@ -100,7 +99,7 @@ if not census_path.exists():
     exit(1)
 
 print(f"Reading census blocks from: {census_path.name}")
-census_gdf = gpd.read_file(census_path)
+census_gdf = pyogrio.read_dataframe(census_path)
 
 print(f"Total census blocks: {len(census_gdf)}")
 print(f"Original census CRS: {census_gdf.crs}")
@@ -143,7 +142,12 @@ print("\n[PART 5] Saving filtered census blocks...")
 
 output_path = Path('census_blocks/canada/Canada_census_blocks_with_schools.gpkg')
 
-blocks_with_schools.to_file(output_path, driver='GPKG', layer='census_blocks')
+pyogrio.write_dataframe(blocks_with_schools, output_path, layer='census_blocks', driver='GPKG')
+
+# Cache as GeoParquet so downstream scripts can skip re-parsing the GPKG
+print("Caching census blocks as GeoParquet...")
+parquet_path = write_census_parquet(blocks_with_schools, output_path)
+print(f"Cached {len(blocks_with_schools)} census blocks: {parquet_path}")
 
 print(f"\n{'=' * 60}")
 print(f"SUCCESS!")
@@ -13,11 +13,16 @@ import duckdb
 from pathlib import Path
 import time
 import traceback
-import fiona
+import multiprocessing
+import pyogrio
+import pyarrow as pa
+import pyarrow.parquet as pq
+import json
 from pyproj import CRS
 import geopandas as gpd
-import os
-import pandas as pd
+import numpy as np
+import shapely
+from shapely import from_wkb, STRtree
 
 # ---------- CONFIG ----------
 BUILDING_DIR = Path("building_data/LoD1/northamerica")
@@ -26,20 +31,40 @@ CANADA_CENSUS = Path("../census_blocks/canada/Canada_census_blocks_with_schools.
 
 OUTPUT_GPKG = Path("../buildings_near_schools.gpkg")
 OUTPUT_CRS = "EPSG:4326"
-N_THREADS = 4
+BUILDING_SRID = 4326  # Native CRS of GlobalBuildingAtlas tiles; census is pre-transformed into it
+N_THREADS = 4  # DuckDB threads per worker
+N_WORKERS = 2  # Tiles processed concurrently, each in its own process
+CENSUS_DB = Path("../census_blocks/census.duckdb")  # Census tables shared read-only with workers
 FILE_STABILITY_WAIT = 15 # 15 second wait time to check file stability
 MIN_FILE_SIZE = 1000 # Processes files at least 1 MB in size
 PROCESSING_LOG = Path("../outputs/TUM_geojson_processing_log.txt")
 BATCH_SIZE = 10000  # Process buildings in chunks to manage memory
+BATCH_MAX_BYTES = 1024 * 1024 * 1024  # Max combined size (bytes) of tiles joined in one DuckDB query; larger tiles run alone
+MAX_WRITE_ATTEMPTS = 3  # GPKG write failures tolerated per tile before it is logged as an error
+PYTHON_TILE_THRESHOLD = 50 * 1024 * 1024  # Tiles under this size (bytes) use the shapely path instead of DuckDB
 # ----------------------------
 
 GEOM_ERROR = object()
 
+_worker_con = None
+_worker_census = None
 
-def _get_srid_via_fiona(path):
+
+def _get_srid_via_pyogrio(path):
     try:
-        with fiona.open(str(path), "r") as src:
-            crs = src.crs
+        crs = pyogrio.read_info(str(path))["crs"]
+        if not crs:
+            return None
+        epsg = CRS.from_user_input(crs).to_epsg()
+        return int(epsg) if epsg is not None else None
+    except Exception:
+        return None
+
+
+def _get_srid_via_geoparquet(path):
+    try:
+        geo = json.loads(pq.read_schema(path).metadata[b"geo"])
+        crs = geo["columns"][geo["primary_column"]].get("crs")
         if not crs:
             return None
         epsg = CRS.from_user_input(crs).to_epsg()
@@ -59,23 +84,51 @@ def _detect_geom_col(con, table_name):
     return None
 
 
-def _is_file_processed(name):
+def _census_parquet(census_path: Path):
+    """GeoParquet copy of a census GPKG, or None when missing or older than the GPKG."""
+    parquet_path = census_path.with_suffix(".parquet")
+    if not parquet_path.is_file():
+        return None
+    if census_path.exists() and parquet_path.stat().st_mtime < census_path.stat().st_mtime:
+        print(f"  ⚠️  {parquet_path.name} is older than {census_path.name} - ignoring it")
+        return None
+    return parquet_path
+
+
+def _load_processed():
+    """Read the processing log once; membership checks then stay in memory."""
     if not PROCESSING_LOG.exists():
-        return False
+        return set()
     try:
         with open(PROCESSING_LOG, "r") as f:
-            return name in {ln.strip() for ln in f if ln.strip()}
+            return {ln.strip() for ln in f if ln.strip()}
     except Exception:
-        return False
+        return set()
 
 
-def _mark_processed(name):
+def _mark_processed(name, processed: set):
+    processed.add(name)
     # Ensure the outputs directory exists
     PROCESSING_LOG.parent.mkdir(exist_ok=True, parents=True)
     with open(PROCESSING_LOG, "a") as f:
         f.write(name + "\n")
 
 
+def _batch_by_size(paths: list, max_bytes=BATCH_MAX_BYTES):
+    """Group tiles in order so each batch's combined file size stays within max_bytes; larger tiles get their own batch."""
+    batches, current, current_bytes = [], [], 0
+    for p in paths:
+        size = p.stat().st_size
+        if current and current_bytes + size > max_bytes:
+            batches.append(current)
+            current, current_bytes = [], 0
+        current.append(p)
+        current_bytes += size
+    if current:
+        batches.append(current)
+    return batches
+
+
 def _is_stable(p: Path, wait=FILE_STABILITY_WAIT):
     try:
         s1 = p.stat()
@@ -88,21 +141,53 @@ def _is_stable(p: Path, wait=FILE_STABILITY_WAIT):
 
 
 def load_census_once(con, census_path: Path, table_name: str):
-    """Load census blocks into DuckDB (done once at startup)."""
-    if not census_path.exists():
+    """Load census blocks into DuckDB (done once at startup), preferring an up-to-date GeoParquet cache."""
+    parquet_path = _census_parquet(census_path)
+    if not census_path.exists() and parquet_path is None:
         return None
     try:
-        print(f"Loading {census_path.name}...")
-        con.execute(f"CREATE OR REPLACE TABLE {table_name} AS SELECT * FROM ST_Read('{census_path}')")
+        if parquet_path is not None:
+            print(f"Loading {parquet_path.name}...")
+            con.execute(f"""
+                CREATE OR REPLACE TABLE {table_name} AS
+                SELECT * EXCLUDE (geometry), geometry AS geom
+                FROM read_parquet('{parquet_path}')
+            """)
+        else:
+            print(f"Loading {census_path.name}...")
+            con.execute(f"CREATE OR REPLACE TABLE {table_name} AS SELECT * FROM ST_Read('{census_path}')")
 
         geom_col = _detect_geom_col(con, table_name)
         if geom_col is None:
             print(f"  ✗ No geometry column in {census_path.name}")
             return None
 
-        srid = _get_srid_via_fiona(census_path)
+        # Spatial index so per-tile joins probe an R-tree instead of scanning every block
+        try:
+            con.execute(f"CREATE INDEX {table_name}_geom_idx ON {table_name} USING RTREE ({geom_col})")
+        except Exception as e:
+            print(f"  ⚠️  Could not build RTREE index on {table_name}: {e}")
+
+        if parquet_path is not None:
+            srid = _get_srid_via_geoparquet(parquet_path)
+        else:
+            srid = _get_srid_via_pyogrio(census_path)
         count = con.execute(f"SELECT COUNT(*) FROM {table_name}").fetchone()[0]
         print(f"  ✓ Loaded {count:,} census blocks (SRID: {srid})")
+
+        # Copy in the buildings' native CRS so tiles in BUILDING_SRID join without any reprojection
+        if srid is not None:
+            native = f"{table_name}_native"
+            con.execute(f"""
+                CREATE OR REPLACE TABLE {native} AS
+                SELECT * REPLACE (ST_Transform(geom, 'EPSG:{srid}', 'EPSG:{BUILDING_SRID}', always_xy := true) AS geom)
+                FROM {table_name}
+            """)
+            try:
+                con.execute(f"CREATE INDEX {native}_geom_idx ON {native} USING RTREE (geom)")
+            except Exception as e:
+                print(f"  ⚠️  Could not build RTREE index on {native}: {e}")
+            print(f"  ✓ Transformed census blocks to EPSG:{BUILDING_SRID}")
         return srid
     except Exception as e:
         print(f"  ✗ Failed to load {census_path.name}:", e)
@@ -110,18 +195,55 @@ def load_census_once(con, census_path: Path, table_name: str):
         return None
 
 
-def process_tile(con, tile_path: Path, us_srid: int, canada_srid: int):
+def _census_extent(con, table_name: str):
+    """Bounding box (xmin, ymin, xmax, ymax) of a census table in its own CRS."""
+    try:
+        return con.execute(f"""
+            SELECT MIN(ST_XMin(geom)), MIN(ST_YMin(geom)), MAX(ST_XMax(geom)), MAX(ST_YMax(geom))
+            FROM {table_name}
+        """).fetchone()
+    except Exception as e:
+        print(f"  ⚠️  Could not compute extent of {table_name}: {e}")
+        return None
+
+
+def _bbox_filter(col: str, bbox):
+    """WHERE clause keeping only geometries whose bbox overlaps the census extent."""
+    if bbox is None:
+        return ""
+    xmin, ymin, xmax, ymax = bbox
+    return (f"WHERE ST_XMax({col}) >= {xmin} AND ST_XMin({col}) <= {xmax} "
+            f"AND ST_YMax({col}) >= {ymin} AND ST_YMin({col}) <= {ymax}")
+
+
+def _retry_tiles_singly(con, tile_paths: list, us_srid: int, canada_srid: int, bboxes):
+    """A failed batch says nothing about its individual tiles: rerun each one on its own."""
+    if len(tile_paths) == 1:
+        return {tile_paths[0]: GEOM_ERROR}
+    print(f"  ↻ Batch failed - retrying its {len(tile_paths)} tiles one at a time")
+    results = {}
+    for p in tile_paths:
+        results.update(process_tiles(con, [p], us_srid, canada_srid, bboxes))
+    return results
+
+
+def process_tiles(con, tile_paths: list, us_srid: int, canada_srid: int, bboxes=None):
     """
-    Process one building tile:
+    Process a batch of building tiles in one pass:
+    - Load all tiles into one table, tagged with source_file
     - Join with US census blocks
     - Join with Canada census blocks
-    - Return filtered buildings in OUTPUT_CRS
+    - Return {tile_path: filtered buildings in OUTPUT_CRS, None or GEOM_ERROR}
+
+    bboxes maps census table names to their extents, used to discard
+    buildings before the exact intersection test.
     """
+    bboxes = bboxes or {}
     tmp_buildings = "buildings_tmp"
 
     try:
         # Get file size
-        file_size_bytes = tile_path.stat().st_size
+        file_size_bytes = sum(p.stat().st_size for p in tile_paths)
         file_size_mb = file_size_bytes / (1024 * 1024)  # Convert to MB
         file_size_gb = file_size_bytes / (1024 * 1024 * 1024)  # Convert to GB
 
@@ -132,32 +254,61 @@ def process_tile(con, tile_path: Path, us_srid: int, canada_srid: int):
             size_str = f"{file_size_mb:.2f} MB"
 
         print(f"\n{'=' * 60}")
-        print(f"Processing: {tile_path.name} ({size_str})")
+        print(f"Processing: {', '.join(p.name for p in tile_paths)} ({size_str})")
         print(f"{'=' * 60}")
 
-        # Load buildings
+        # Load buildings; one scan over all tiles, each row tagged with its tile
         print("  Loading buildings into DuckDB...")
-        con.execute(f"CREATE OR REPLACE TABLE {tmp_buildings} AS SELECT * FROM ST_Read('{tile_path}')")
+        reads = " UNION ALL BY NAME ".join(
+            f"SELECT *, '{p.name}' AS source_file FROM ST_Read('{p}')" for p in tile_paths
+        )
+        con.execute(f"CREATE OR REPLACE TABLE {tmp_buildings} AS {reads}")
+        # ST_Read adds a feature-id column that pyogrio does not; drop it so both paths
+        # append the same fields to the output layer
+        con.execute(f"ALTER TABLE {tmp_buildings} DROP COLUMN IF EXISTS OGC_FID")
 
         geom_col = _detect_geom_col(con, tmp_buildings)
         if geom_col is None:
             print("  ✗ No geometry column in buildings")
             con.execute(f"DROP TABLE IF EXISTS {tmp_buildings}")
-            return GEOM_ERROR
+            return _retry_tiles_singly(con, tile_paths, us_srid, canada_srid, bboxes)
 
         # Get building SRID
         try:
             b_srid = con.execute(f"SELECT ST_SRID({geom_col}) FROM {tmp_buildings} LIMIT 1").fetchone()[0]
             b_srid = int(b_srid)
         except Exception:
-            b_srid = _get_srid_via_fiona(tile_path)
+            b_srid = _get_srid_via_pyogrio(tile_paths[0])
             if b_srid is None:
                 print("  ✗ Could not detect building SRID")
                 con.execute(f"DROP TABLE IF EXISTS {tmp_buildings}")
-                return GEOM_ERROR
+                return _retry_tiles_singly(con, tile_paths, us_srid, canada_srid, bboxes)
 
         total_buildings = con.execute(f"SELECT COUNT(*) FROM {tmp_buildings}").fetchone()[0]
-        print(f"  Buildings in tile: {total_buildings:,} (SRID: {b_srid})")
+        print(f"  Buildings in batch: {total_buildings:,} (SRID: {b_srid})")
+
+        # Tiles in BUILDING_SRID join against the pre-transformed census copies as-is;
+        # anything else is reprojected once per target CRS into materialised columns
+        native = b_srid == BUILDING_SRID
+        transforms = {}
+        if f"EPSG:{b_srid}" != OUTPUT_CRS:
+            transforms["geom_out"] = OUTPUT_CRS
+        if not native and us_srid is not None:
+            transforms["geom_us"] = f"EPSG:{us_srid}"
+        if not native and canada_srid is not None:
+            transforms["geom_ca"] = f"EPSG:{canada_srid}"
+        if transforms:
+            print("  Reprojecting buildings...")
+        for col, target in transforms.items():
+            con.execute(f"ALTER TABLE {tmp_buildings} ADD COLUMN {col} GEOMETRY")
+            con.execute(f"""
+                UPDATE {tmp_buildings}
+                SET {col} = ST_Transform({geom_col}, 'EPSG:{b_srid}', '{target}', always_xy := true)
+            """)
+        exclude_cols = ", ".join([geom_col, *transforms])
+        out_col = "geom_out" if "geom_out" in transforms else geom_col
+        us_table, us_col = ("census_us_native", geom_col) if native else ("census_us", "geom_us")
+        ca_table, ca_col = ("census_canada_native", geom_col) if native else ("census_canada", "geom_ca")
 
         results = []
 
@@ -165,22 +316,19 @@ def process_tile(con, tile_path: Path, us_srid: int, canada_srid: int):
         if us_srid is not None:
             print(f"  Checking US census blocks...")
             sql = f"""
-                SELECT b.* EXCLUDE {geom_col},
-                       ST_AsWKB(ST_Transform(b.{geom_col}, 'EPSG:{b_srid}', '{OUTPUT_CRS}')) AS geom_wkb
+                SELECT b.* EXCLUDE ({exclude_cols}),
+                       ST_AsWKB(b.{out_col}) AS geom_wkb
                 FROM {tmp_buildings} b
-                INNER JOIN census_us c
-                  ON ST_Intersects(
-                      ST_Transform(b.{geom_col}, 'EPSG:{b_srid}', 'EPSG:{us_srid}'),
-                      c.geom
-                  )
+                INNER JOIN {us_table} c
+                  ON ST_Intersects(b.{us_col}, c.geom)
+                {_bbox_filter(f"b.{us_col}", bboxes.get(us_table))}
             """
 
             try:
-                us_matches = con.execute(f"SELECT COUNT(*) FROM ({sql})").fetchone()[0]
-                if us_matches > 0:
-                    print(f"    ✓ Found {us_matches:,} buildings in US school areas")
-                    df = con.execute(sql).df()
-                    results.append(df)
+                tbl = con.execute(sql).to_arrow_table()
+                if tbl.num_rows > 0:
+                    print(f"    ✓ Found {tbl.num_rows:,} buildings in US school areas")
+                    results.append(tbl)
                 else:
                     print(f"    No US matches")
             except Exception as e:
@@ -190,22 +338,19 @@ def process_tile(con, tile_path: Path, us_srid: int, canada_srid: int):
         if canada_srid is not None:
             print(f"  Checking Canada census blocks...")
             sql = f"""
-                SELECT b.* EXCLUDE {geom_col},
-                       ST_AsWKB(ST_Transform(b.{geom_col}, 'EPSG:{b_srid}', '{OUTPUT_CRS}')) AS geom_wkb
+                SELECT b.* EXCLUDE ({exclude_cols}),
+                       ST_AsWKB(b.{out_col}) AS geom_wkb
                 FROM {tmp_buildings} b
-                INNER JOIN census_canada c
-                  ON ST_Intersects(
-                      ST_Transform(b.{geom_col}, 'EPSG:{b_srid}', 'EPSG:{canada_srid}'),
-                      c.geom
-                  )
+                INNER JOIN {ca_table} c
+                  ON ST_Intersects(b.{ca_col}, c.geom)
+                {_bbox_filter(f"b.{ca_col}", bboxes.get(ca_table))}
             """
 
             try:
-                ca_matches = con.execute(f"SELECT COUNT(*) FROM ({sql})").fetchone()[0]
-                if ca_matches > 0:
-                    print(f"    ✓ Found {ca_matches:,} buildings in Canada school areas")
-                    df = con.execute(sql).df()
-                    results.append(df)
+                tbl = con.execute(sql).to_arrow_table()
+                if tbl.num_rows > 0:
+                    print(f"    ✓ Found {tbl.num_rows:,} buildings in Canada school areas")
+                    results.append(tbl)
                 else:
                     print(f"    No Canada matches")
             except Exception as e:
@@ -216,56 +361,125 @@ def process_tile(con, tile_path: Path, us_srid: int, canada_srid: int):
 
         if not results:
             print("  → No buildings in school areas")
-            return None
+            return dict.fromkeys(tile_paths)
 
         # Combine US + Canada results if both exist
-        combined = pd.concat(results, ignore_index=True)
+        combined = pa.concat_tables(results)
 
-        # Convert WKB to GeoDataFrame
-        from shapely import wkb
-        combined['geometry'] = combined['geom_wkb'].apply(lambda x: wkb.loads(bytes(x)))
-        combined = combined.drop('geom_wkb', axis=1)
-        gdf = gpd.GeoDataFrame(combined, geometry='geometry', crs=OUTPUT_CRS)
+        # Decode the WKB column straight from Arrow; only attribute columns go through pandas
+        geoms = from_wkb(combined.column('geom_wkb').to_numpy(zero_copy_only=False))
+        attr_df = combined.drop(['geom_wkb']).to_pandas()
+        gdf = gpd.GeoDataFrame(attr_df, geometry=geoms, crs=OUTPUT_CRS)
 
-        print(f"  ✓ Total filtered buildings: {len(gdf):,}")
-        return gdf
+        # Split the batch result back into per-tile results
+        by_name = {p.name: p for p in tile_paths}
+        tile_results = dict.fromkeys(tile_paths)
+        for name, part in gdf.groupby("source_file"):
+            tile_results[by_name[name]] = part.drop(columns="source_file").reset_index(drop=True)
+            print(f"  ✓ {name}: {len(part):,} filtered buildings")
+        return tile_results
 
     except Exception as e:
-        print(f"  ✗ Error processing tile: {e}")
+        print(f"  ✗ Error processing tiles: {e}")
         traceback.print_exc()
         try:
             con.execute(f"DROP TABLE IF EXISTS {tmp_buildings}")
         except:
             pass
+        return _retry_tiles_singly(con, tile_paths, us_srid, canada_srid, bboxes)
+
+
+def load_census_python(census_path: Path):
+    """Load census blocks for the shapely path: geometries in BUILDING_SRID, prepared, with an STRtree."""
+    parquet_path = _census_parquet(census_path)
+    if parquet_path is not None:
+        census = gpd.read_parquet(parquet_path)
+    elif census_path.exists():
+        census = pyogrio.read_dataframe(census_path)
+    else:
+        return None
+    geoms = np.asarray(census.to_crs(f"EPSG:{BUILDING_SRID}").geometry)
+    # Prepared geometries make repeated intersects tests against the same block cheap
+    shapely.prepare(geoms)
+    return geoms, STRtree(geoms)
+
+
+def process_tile_python(tile_path: Path, census: dict):
+    """
+    Shapely fallback for process_tiles, used for small tiles or when the
+    DuckDB spatial extension is unavailable. Candidate pairs come from an
+    STRtree over the census blocks and are refined with prepared geometries.
+    """
+    try:
+        print(f"\n{'=' * 60}")
+        print(f"Processing: {tile_path.name} (shapely)")
+        print(f"{'=' * 60}")
+
+        buildings = pyogrio.read_dataframe(tile_path)
+        if buildings.crs is None:
+            print("  ✗ Could not detect building SRID")
+            return GEOM_ERROR
+        print(f"  Buildings in tile: {len(buildings):,} (CRS: {buildings.crs})")
+
+        buildings = buildings.to_crs(f"EPSG:{BUILDING_SRID}")
+        b_geoms = np.asarray(buildings.geometry)
+
+        matches = []
+        for label, (geoms, tree) in census.items():
+            print(f"  Checking {label} census blocks...")
+            b_idx, c_idx = tree.query(b_geoms)
+            hit = shapely.intersects(geoms[c_idx], b_geoms[b_idx])
+            if hit.any():
+                print(f"    ✓ Found {hit.sum():,} buildings in {label} school areas")
+                matches.append(b_idx[hit])
+            else:
+                print(f"    No {label} matches")
+
+        if not matches:
+            print("  → No buildings in school areas")
+            return None
+
+        gdf = buildings.iloc[np.concatenate(matches)].to_crs(OUTPUT_CRS).reset_index(drop=True)
+        print(f"  ✓ Total filtered buildings: {len(gdf):,}")
+        return gdf
+
+    except Exception as e:
+        print(f"  ✗ Error processing tile: {e}")
+        traceback.print_exc()
         return GEOM_ERROR
 
 
 def append_to_gpkg(gdf: gpd.GeoDataFrame, output_path: Path):
-    """Append buildings to the master GPKG (with error handling)."""
+    """Append buildings to the master GPKG (with error handling); returns True if the write succeeded."""
     try:
         # Ensure output directory exists
         output_path.parent.mkdir(parents=True, exist_ok=True)
 
         if output_path.exists():
-            # Read existing, concat, write back (safer but slower for large files)
-            existing = gpd.read_file(output_path, layer="buildings")
-            combined = pd.concat([existing, gdf], ignore_index=True)
-
-            # Use proper .gpkg.tmp extension to avoid warning
-            tmp_path = output_path.parent / f"{output_path.stem}_tmp.gpkg"
-            combined.to_file(tmp_path, driver="GPKG", layer="buildings")
-            os.replace(tmp_path, output_path)
-            print(f"  ✓ Appended {len(gdf):,} buildings (total: {len(combined):,})")
+            # Appending cannot add fields, so drop any the layer lacks (tiles and batches can differ in schema)
+            layer_fields = set(pyogrio.read_info(output_path, layer="buildings")["fields"])
+            extra = [c for c in gdf.columns if c != gdf.geometry.name and c not in layer_fields]
+            if extra:
+                print(f"  ⚠️  Dropping fields not in the buildings layer: {', '.join(extra)}")
+                gdf = gdf.drop(columns=extra)
+
+            # Append new rows in place; existing features are never re-read or rewritten
+            pyogrio.write_dataframe(gdf, output_path, layer="buildings", driver="GPKG", append=True)
+            total = pyogrio.read_info(output_path, layer="buildings")["features"]
+            print(f"  ✓ Appended {len(gdf):,} buildings (total: {total:,})")
         else:
-            gdf.to_file(output_path, driver="GPKG", layer="buildings")
+            pyogrio.write_dataframe(gdf, output_path, layer="buildings", driver="GPKG")
             print(f"  ✓ Created {output_path.name} with {len(gdf):,} buildings")
+        return True
     except Exception as e:
         print(f"  ✗ Failed to write to GPKG: {e}")
         traceback.print_exc()
+        return False
 
-def main():
-    # Connect to DuckDB
-    con = duckdb.connect()
+
+def _connect(database=":memory:"):
+    """Open a DuckDB connection with the spatial extension loaded."""
+    con = duckdb.connect(database)
     try:
         con.execute(f"PRAGMA threads={N_THREADS};")
     except:
@@ -280,18 +494,103 @@ def main():
             con.execute("LOAD spatial;")
         except Exception as e:
             print("Failed to load DuckDB spatial extension:", e)
-            return
+            con.close()
+            return None
+    return con
+
+
+def _init_worker():
+    """Give each worker its own connection with the persisted census tables attached read-only."""
+    global _worker_con
+    _worker_con = _connect()
+    if _worker_con is None:
+        return
+    # A crashing initializer is respawned by the Pool forever; fall back to the shapely path instead
+    try:
+        _worker_con.execute(f"ATTACH '{CENSUS_DB}' AS census (READ_ONLY)")
+    except Exception as e:
+        print(f"⚠️  Could not attach {CENSUS_DB} - this worker will use the shapely path: {e}")
+        _worker_con.close()
+        _worker_con = None
+        return
+    for table_name in ("census_us", "census_canada", "census_us_native", "census_canada_native"):
+        try:
+            _worker_con.execute(f"CREATE VIEW {table_name} AS SELECT * FROM census.{table_name}")
+        except Exception:
+            pass
+
+
+def _process_tiles_worker(args):
+    """Run a batch of tiles in a worker; GEOM_ERROR does not survive pickling, so flag it explicitly."""
+    global _worker_census
+    tile_paths, us_srid, canada_srid, bboxes, census_labels = args
+
+    results = {}
+    try:
+        small = []
+        for p in tile_paths:
+            try:
+                if _worker_con is None or p.stat().st_size < PYTHON_TILE_THRESHOLD:
+                    small.append(p)
+            except OSError as e:
+                print(f"  ✗ Could not read {p.name}: {e}")
+                results[p] = GEOM_ERROR
+        if small:
+            # Census is only loaded into Python the first time this worker needs the fallback,
+            # and only the sets main() loaded, so both paths join against the same blocks
+            if _worker_census is None:
+                try:
+                    census = {}
+                    for label, census_path in (("US", US_CENSUS), ("Canada", CANADA_CENSUS)):
+                        if label in census_labels:
+                            loaded = load_census_python(census_path)
+                            if loaded is not None:
+                                census[label] = loaded
+                    _worker_census = census
+                except Exception as e:
+                    print(f"  ✗ Failed to load census blocks for the shapely path: {e}")
+                    traceback.print_exc()
+            for p in small:
+                results[p] = GEOM_ERROR if _worker_census is None else process_tile_python(p, _worker_census)
+
+        large = [p for p in tile_paths if p not in results]
+        if large:
+            results.update(process_tiles(_worker_con, large, us_srid, canada_srid, bboxes))
+    except Exception as e:
+        # Never let one batch take down the pool and main(); unfinished tiles are flagged instead
+        print(f"  ✗ Error processing batch: {e}")
+        traceback.print_exc()
+
+    return [(p, None, True) if results.get(p, GEOM_ERROR) is GEOM_ERROR else (p, results[p], False)
+            for p in tile_paths]
 
-    # Load census blocks ONCE at startup
+
+def main():
+    # Load census blocks ONCE at startup into a persistent DuckDB file
     print("\n" + "=" * 60)
     print("LOADING CENSUS BLOCKS")
     print("=" * 60)
-    us_srid = load_census_once(con, US_CENSUS, "census_us")
-    canada_srid = load_census_once(con, CANADA_CENSUS, "census_canada")
-
-    if us_srid is None and canada_srid is None:
-        print("\n✗ No census blocks loaded - aborting")
+    CENSUS_DB.parent.mkdir(parents=True, exist_ok=True)
+    con = _connect(str(CENSUS_DB))
+    bboxes = {}
+    if con is not None:
+        us_srid = load_census_once(con, US_CENSUS, "census_us")
+        canada_srid = load_census_once(con, CANADA_CENSUS, "census_canada")
+        for table_name, srid in (("census_us", us_srid), ("census_canada", canada_srid)):
+            if srid is not None:
+                bboxes[table_name] = _census_extent(con, table_name)
+                bboxes[f"{table_name}_native"] = _census_extent(con, f"{table_name}_native")
+        # Release the write lock so workers can attach the file read-only
         con.close()
+        census_labels = {label for label, srid in (("US", us_srid), ("Canada", canada_srid)) if srid is not None}
+    else:
+        print("⚠️  DuckDB spatial unavailable - every tile will use the shapely path")
+        us_srid = canada_srid = None
+        census_labels = {label for label, p in (("US", US_CENSUS), ("Canada", CANADA_CENSUS))
+                         if p.exists() or _census_parquet(p) is not None}
+
+    if not census_labels:
+        print("\n✗ No census blocks loaded - aborting")
         return
 
     # Process building tiles continuously
@@ -301,65 +600,77 @@ def main():
 
     processed_count = 0
     error_count = 0
-
-    while True:
-        # Find unprocessed files
-        files = sorted(BUILDING_DIR.glob("*.geojson"))
-        unprocessed = [f for f in files if not _is_file_processed(f.name)]
-
-        if not unprocessed:
-            print(f"\nNo new files to process. Waiting 15 seconds...")
-            time.sleep(15)
-            continue
-
-        print(f"\nFound {len(unprocessed)} unprocessed files")
-
-        for tile_path in unprocessed:
-            # Check if file is stable (finished downloading)
-            if not _is_stable(tile_path):
-                print(f"\n⏳ {tile_path.name} - still downloading, skipping for now")
+    processed = _load_processed()
+    write_failures = {}  # Tile name -> failed GPKG writes so far
+
+    with multiprocessing.Pool(N_WORKERS, initializer=_init_worker) as pool:
+        while True:
+            # Find unprocessed files
+            files = sorted(BUILDING_DIR.glob("*.geojson"))
+            unprocessed = [f for f in files if f.name not in processed]
+
+            if not unprocessed:
+                print(f"\nNo new files to process. Waiting 15 seconds...")
+                time.sleep(15)
                 continue
 
-            # Process the tile
-            result = process_tile(con, tile_path, us_srid, canada_srid)
-
-            if result is GEOM_ERROR:
-                print(f"  ✗ Geometry error - keeping file for inspection")
-                _mark_processed(tile_path.name)
-                error_count += 1
-                continue
-
-            if result is None:
-                print(f"  → No matches - marking as processed and deleting file")
-                _mark_processed(tile_path.name)
-                processed_count += 1  # ADD THIS LINE
-                # Delete since no errors, just no matches
+            print(f"\nFound {len(unprocessed)} unprocessed files")
+
+            # Check which files are stable (finished downloading)
+            ready = []
+            for tile_path in unprocessed:
+                if not _is_stable(tile_path):
+                    print(f"\n⏳ {tile_path.name} - still downloading, skipping for now")
+                    continue
+                ready.append(tile_path)
+            batches = [(batch, us_srid, canada_srid, bboxes, census_labels) for batch in _batch_by_size(ready)]
+
+            # Workers process batches in parallel; writing stays in this process so appends are serialised
+            tile_results = (r for batch in pool.imap_unordered(_process_tiles_worker, batches) for r in batch)
+            for tile_path, result, geom_error in tile_results:
+                if geom_error:
+                    print(f"  ✗ {tile_path.name}: geometry error - keeping file for inspection")
+                    _mark_processed(tile_path.name, processed)
+                    error_count += 1
+                    continue
+
+                if result is None:
+                    print(f"  → {tile_path.name}: no matches - marking as processed and deleting file")
+                    _mark_processed(tile_path.name, processed)
+                    processed_count += 1
+                    # Delete since no errors, just no matches
+                    try:
+                        tile_path.unlink()
+                        print(f"  🗑️  Deleted {tile_path.name}")
+                    except Exception as e:
+                        print(f"  ⚠️  Could not delete: {e}")
+
+                    print(f"\n📊 Progress: {processed_count} tiles processed, {error_count} errors")
+                    continue
+
+                # Append to master GPKG; a failed write is retried on a later pass, up to MAX_WRITE_ATTEMPTS
+                if not append_to_gpkg(result, OUTPUT_GPKG):
+                    failures = write_failures[tile_path.name] = write_failures.get(tile_path.name, 0) + 1
+                    if failures < MAX_WRITE_ATTEMPTS:
+                        print(f"  ✗ {tile_path.name}: write failed ({failures}/{MAX_WRITE_ATTEMPTS}) - will retry")
+                        continue
+                    print(f"  ✗ {tile_path.name}: write failed {failures} times - keeping file for inspection")
+                    _mark_processed(tile_path.name, processed)
+                    error_count += 1
+                    continue
+                _mark_processed(tile_path.name, processed)
+                processed_count += 1
+
+                # DELETE THE ORIGINAL FILE (successful processing, no errors)
                 try:
                     tile_path.unlink()
                     print(f"  🗑️  Deleted {tile_path.name}")
                 except Exception as e:
-                    print(f"  ⚠️  Could not delete: {e}")
-
-                print(f"\n📊 Progress: {processed_count} tiles processed, {error_count} errors")  # ADD THIS LINE
-                continue
-
-            # Append to master GPKG
-            append_to_gpkg(result, OUTPUT_GPKG)
-            _mark_processed(tile_path.name)
-            processed_count += 1
-
-            # DELETE THE ORIGINAL FILE (successful processing, no errors)
-            try:
-                tile_path.unlink()
-                print(f"  🗑️  Deleted {tile_path.name}")
-            except Exception as e:
-                print(f"  ⚠️  Could not delete {tile_path.name}: {e}")
-
-            print(f"\n📊 Progress: {processed_count} tiles processed, {error_count} errors")
+                    print(f"  ⚠️  Could not delete {tile_path.name}: {e}")
 
-        time.sleep(60)  # Wait before checking for new files
+                print(f"\n📊 Progress: {processed_count} tiles processed, {error_count} errors")
 
-    con.close()
+            time.sleep(60)  # Wait before checking for new files
 
 
 if __name__ == "__main__":
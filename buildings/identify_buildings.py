@@ -3,9 +3,20 @@ Complete workflow: Identify tiles from census blocks and create download pattern
 """
 
 import geopandas as gpd
+import pyogrio
 from pathlib import Path
 import pandas as pd
-from ftplib import FTP
+import numpy as np
+from ftplib import FTP, error_perm
+from functools import reduce
+
+try:
+    from numba import njit, prange
+except ImportError:
+    # Without numba the tile kernel below runs as plain Python; it only sees the rare multi-tile blocks
+    def njit(*args, **kwargs):
+        return lambda func: func
+    prange = range
 
 print("=" * 60)
 print("GlobalBuildingAtlas Download Preparation")
@@ -21,100 +32,184 @@ print("\n[PART 1] Loading census blocks with schools...")
 us_census_path = Path('../census_blocks/united_states/US_census_blocks_with_schools.gpkg')
 canada_census_path = Path('../census_blocks/canada/Canada_census_blocks_with_schools.gpkg')
 
-census_blocks = []
+# Bounds of every block from the last run; valid while newer than all census block inputs
+bounds_cache = Path('../outputs/census_block_bounds.parquet')
+census_sources = [p for p in (us_census_path, canada_census_path,
+                              us_census_path.with_suffix('.parquet'), canada_census_path.with_suffix('.parquet'))
+                  if p.exists()]
+use_bounds_cache = (bounds_cache.exists() and bool(census_sources) and
+                    bounds_cache.stat().st_mtime > max(p.stat().st_mtime for p in census_sources))
 
-# Load US census blocks
-if us_census_path.exists():
-    print(f"\nLoading US census blocks: {us_census_path}")
-    us_blocks = gpd.read_file(us_census_path)
-    us_blocks = us_blocks.to_crs('EPSG:4326')
-    print(f"  Loaded {len(us_blocks)} census blocks")
-    census_blocks.append(us_blocks)
-else:
-    print(f"\nWARNING: US census blocks not found at {us_census_path}")
-
-# Load Canada census blocks
-if canada_census_path.exists():
-    print(f"\nLoading Canada census blocks: {canada_census_path}")
-    canada_blocks = gpd.read_file(canada_census_path)
-    canada_blocks = canada_blocks.to_crs('EPSG:4326')
-    print(f"  Loaded {len(canada_blocks)} census blocks")
-    census_blocks.append(canada_blocks)
+if use_bounds_cache:
+    print(f"\nBounds cache is up to date, skipping census block geometries: {bounds_cache}")
 else:
-    print(f"\nWARNING: Canada census blocks not found at {canada_census_path}")
-
-if not census_blocks:
-    print("\nERROR: No census block files found!")
-    exit(1)
-
-# Combine all census blocks
-print("\nCombining census blocks...")
-all_blocks = gpd.GeoDataFrame(
-    pd.concat(census_blocks, ignore_index=True),
-    crs='EPSG:4326'
-)
-print(f"Total census blocks with schools: {len(all_blocks)}")
+    census_blocks = []
+
+    # Load US census blocks
+    if us_census_path.exists():
+        us_parquet = us_census_path.with_suffix('.parquet')
+        if us_parquet.is_file() and us_parquet.stat().st_mtime >= us_census_path.stat().st_mtime:
+            print(f"\nLoading US census blocks: {us_parquet}")
+            us_blocks = gpd.read_parquet(us_parquet)
+        else:
+            print(f"\nLoading US census blocks: {us_census_path}")
+            us_blocks = pyogrio.read_dataframe(us_census_path)
+        us_blocks = us_blocks.to_crs('EPSG:4326')
+        print(f"  Loaded {len(us_blocks)} census blocks")
+        census_blocks.append(us_blocks)
+    else:
+        print(f"\nWARNING: US census blocks not found at {us_census_path}")
+
+    # Load Canada census blocks
+    if canada_census_path.exists():
+        canada_parquet = canada_census_path.with_suffix('.parquet')
+        if canada_parquet.is_file() and canada_parquet.stat().st_mtime >= canada_census_path.stat().st_mtime:
+            print(f"\nLoading Canada census blocks: {canada_parquet}")
+            canada_blocks = gpd.read_parquet(canada_parquet)
+        else:
+            print(f"\nLoading Canada census blocks: {canada_census_path}")
+            canada_blocks = pyogrio.read_dataframe(canada_census_path)
+        canada_blocks = canada_blocks.to_crs('EPSG:4326')
+        print(f"  Loaded {len(canada_blocks)} census blocks")
+        census_blocks.append(canada_blocks)
+    else:
+        print(f"\nWARNING: Canada census blocks not found at {canada_census_path}")
+
+    if not census_blocks:
+        print("\nERROR: No census block files found!")
+        exit(1)
+
+    # Combine all census blocks
+    print("\nCombining census blocks...")
+    all_blocks = gpd.GeoDataFrame(
+        pd.concat(census_blocks, ignore_index=True),
+        crs='EPSG:4326'
+    )
+    print(f"Total census blocks with schools: {len(all_blocks)}")
 
 
 # ============================================================================
 # PART 2: Identify required tiles from census block geometries
 # ============================================================================
 
-def get_tile_name(lat, lon):
-    """Get tile name for a given lat/lon coordinate"""
-    tile_lat = (lat // 5) * 5
-    tile_lon = (lon // 5) * 5
-    lat_str = f"N{int(tile_lat):02d}"
-    lon_str = f"W{abs(int(tile_lon)):03d}"
-    return f"{lat_str}_{lon_str}"
+TILE_SIZE = 5  # Tiles are 5x5 degrees
+TILE_KEY_OFFSET = 512  # Keeps packed tile coordinates non-negative
+
+
+def pack_tile_keys(tile_lat, tile_lon):
+    """Pack tile south-west corners (degrees) into int64 keys"""
+    tile_lat = np.asarray(tile_lat, dtype=np.int64)
+    tile_lon = np.asarray(tile_lon, dtype=np.int64)
+    return ((tile_lat + TILE_KEY_OFFSET) << 10) | (tile_lon + TILE_KEY_OFFSET)
+
+
+def unpack_tile_keys(keys):
+    """Inverse of pack_tile_keys -> (tile_lat, tile_lon) int64 arrays"""
+    keys = np.asarray(keys, dtype=np.int64)
+    return (keys >> 10) - TILE_KEY_OFFSET, (keys & 0x3FF) - TILE_KEY_OFFSET
+
+
+@njit(parallel=True, cache=True)
+def enumerate_tile_keys(lat_i0, lat_i1, lon_j0, lon_j1):
+    """Packed keys of every tile in each block's inclusive range of tile indices, as one flat int64 array"""
+    n = len(lat_i0)
+    offsets = np.zeros(n + 1, dtype=np.int64)
+    for b in range(n):
+        offsets[b + 1] = offsets[b] + (lat_i1[b] - lat_i0[b] + 1) * (lon_j1[b] - lon_j0[b] + 1)
 
+    keys = np.empty(offsets[n], dtype=np.int64)
+    for b in prange(n):
+        k = offsets[b]
+        for i in range(lat_i0[b], lat_i1[b] + 1):
+            for j in range(lon_j0[b], lon_j1[b] + 1):
+                keys[k] = ((i * TILE_SIZE + TILE_KEY_OFFSET) << 10) | (j * TILE_SIZE + TILE_KEY_OFFSET)
+                k += 1
+    return keys
 
-def get_tiles_for_geometry(geometry):
-    """Get all tiles that a geometry overlaps"""
-    tiles = set()
-    bounds = geometry.bounds
-    minx, miny, maxx, maxy = bounds
 
-    lats = range(int(miny), int(maxy) + 2)
-    lons = range(int(minx), int(maxx) + 2)
+def get_tile_ranges(bounds):
+    """
+    Tile index range per block from its (minx, miny, maxx, maxy) bounds:
+    floor(min / 5) .. floor((max + 1) / 5), the max padded by one degree as before
+    """
+    lon_j0 = np.floor(bounds[:, 0] / TILE_SIZE).astype(np.int32)
+    lat_i0 = np.floor(bounds[:, 1] / TILE_SIZE).astype(np.int32)
+    lon_j1 = ((np.floor(bounds[:, 2]) + 1) // TILE_SIZE).astype(np.int32)
+    lat_i1 = ((np.floor(bounds[:, 3]) + 1) // TILE_SIZE).astype(np.int32)
+    return lat_i0, lat_i1, lon_j0, lon_j1
+
+
+def get_required_tiles_from_bounds(bounds):
+    """Packed keys of all tiles covered by the blocks' bounds"""
+    lat_i0, lat_i1, lon_j0, lon_j1 = get_tile_ranges(bounds)
+
+    # Most blocks sit inside a single tile: their keys go straight into the set
+    single = (lat_i0 == lat_i1) & (lon_j0 == lon_j1)
+    required_tiles = set(pack_tile_keys(lat_i0[single] * TILE_SIZE, lon_j0[single] * TILE_SIZE).tolist())
+
+    # Only the rare multi-tile blocks enumerate their tile range, all of them in one compiled kernel call
+    multi = ~single
+    print(f"  Single-tile blocks: {single.sum()}, multi-tile blocks: {multi.sum()}")
+    if multi.any():
+        multi_keys = enumerate_tile_keys(lat_i0[multi], lat_i1[multi], lon_j0[multi], lon_j1[multi])
+        required_tiles.update(np.unique(multi_keys).tolist())
+    return required_tiles
 
-    for lat in lats:
-        for lon in lons:
-            tile = get_tile_name(lat, lon)
-            tiles.add(tile)
 
-    return tiles
+def concat_strings(*parts):
+    """Element-wise concatenation of string arrays and scalars -> array of strings"""
+    return reduce(np.char.add, parts)
 
 
 print("\n[PART 2] Identifying required tiles from census blocks...")
 
-required_tiles = set()
+if use_bounds_cache:
+    bounds = pd.read_parquet(bounds_cache).to_numpy()
+    n_blocks = len(bounds)
+    print(f"  Loaded bounds of {n_blocks} census blocks")
+    required_tiles = get_required_tiles_from_bounds(bounds)
+else:
+    # Null and empty geometries have no bounds; drop them once up front
+    has_geometry = all_blocks.geometry.notna() & ~all_blocks.geometry.is_empty
+    if not has_geometry.all():
+        print(f"  Skipping {(~has_geometry).sum()} census blocks with null or empty geometry")
+    n_blocks = int(has_geometry.sum())
 
-for idx, row in all_blocks.iterrows():
-    if idx % 1000 == 0:
-        print(f"  Processing block {idx}/{len(all_blocks)}...", end='\r')
+    # Extract every block's bounds in one vectorised call (minx, miny, maxx, maxy) and cache them for reruns
+    block_bounds = all_blocks.geometry[has_geometry].bounds
+    block_bounds.to_parquet(bounds_cache, index=False)
+    print(f"  Cached block bounds: {bounds_cache}")
 
-    try:
-        geometry = row.geometry
-        block_tiles = get_tiles_for_geometry(geometry)
-        required_tiles.update(block_tiles)
-    except Exception as e:
-        continue
+    required_tiles = get_required_tiles_from_bounds(block_bounds.to_numpy())
 
-print(f"\n  Completed processing {len(all_blocks)} census blocks")
+print(f"\n  Completed processing {n_blocks} census blocks")
 print(f"\nTotal unique tiles needed: {len(required_tiles)}")
 
-# Sort tiles
-sorted_tiles = sorted(list(required_tiles))
+# Sort the integer keys rather than formatted names: latitude ascending, then west longitude ascending,
+# which is the same order the N{lat}_W{lon} names sort in; names are formatted once, already in order
+keys = np.fromiter(required_tiles, dtype=np.int64, count=len(required_tiles))
+tile_lat, tile_lon = unpack_tile_keys(keys)
+order = np.lexsort((-tile_lon, tile_lat))
+tile_lat, tile_lon = tile_lat[order], tile_lon[order]
+# Tile names and server filenames are formatted together from the same integers, e.g.
+#   N45_W075 -> covers 45-50°N, 70-75°W
+#   Server file: w075_n50_w070_n45.geojson  (w[west]_n[north]_w[east]_n[south])
+south = np.char.mod('%02d', tile_lat)
+north = np.char.mod('%02d', tile_lat + TILE_SIZE)
+west = np.char.mod('%03d', np.abs(tile_lon))
+east = np.char.mod('%03d', np.abs(tile_lon) - TILE_SIZE)
+tile_names = concat_strings('N', south, '_W', west)
+tile_filenames = concat_strings('w', west, '_n', north, '_w', east, '_n', south)
+sorted_tiles = tile_names.tolist()
 
 # Save tile list
 tile_list_file = '../outputs/required_building_tiles_from_census.txt'
-with open(tile_list_file, 'w') as f:
-    f.write("Required GlobalBuildingAtlas Tiles\n")
-    f.write("=" * 60 + "\n\n")
-    f.write(f"Total tiles: {len(sorted_tiles)}\n\n")
-    for tile in sorted_tiles:
-        f.write(f"{tile}\n")
+OUTPUT_BUFFER_SIZE = 1 << 20  # Each output file is built in memory and written in one call
+
+lines = ["Required GlobalBuildingAtlas Tiles", "=" * 60, "", f"Total tiles: {len(sorted_tiles)}", ""]
+lines.extend(sorted_tiles)
+with open(tile_list_file, 'w', buffering=OUTPUT_BUFFER_SIZE) as f:
+    f.write("\n".join(lines) + "\n")
 
 print(f"Tile list saved to: {tile_list_file}")
 
@@ -124,41 +219,11 @@ print(f"Tile list saved to: {tile_list_file}")
 
 print("\n[PART 3] Mapping tile names to server filenames...")
 
-
-def tile_to_filename(tile_name):
-    """
-    Example:
-    N45_W075 -> covers 45-50°N, 70-75°W
-    Server file: w075_n50_w070_n45.geojson
-                 (west=75, north=50, east=70, south=45)
-    """
-    parts = tile_name.split('_')
-    lat_str = parts[0][1:]
-    lon_str = parts[1][1:]
-
-    lat_south = int(lat_str)  # 45
-    lat_north = lat_south + 5  # 50
-
-    lon_west = int(lon_str)  # 75
-    lon_east = lon_west - 5  # 70
-
-    # Server format: w[west]_n[north]_w[east]_n[south]
-    filename = f"w{lon_west:03d}_n{lat_north:02d}_w{lon_east:03d}_n{lat_south:02d}"
-
-    return filename
-
-
-# Create mapping
-tile_mapping = {}
-for tile in sorted_tiles:
-    filename = tile_to_filename(tile)
-    tile_mapping[tile] = filename
-
 # Show sample mapping
 print("\nSample tile mappings (first 10):")
 print("-" * 60)
-for tile in sorted_tiles[:10]:
-    print(f"{tile:15s} -> {tile_mapping[tile]}.geojson")
+for tile, filename in zip(sorted_tiles[:10], tile_filenames):
+    print(f"{tile:15s} -> {filename}.geojson")
 print(f"... ({len(sorted_tiles) - 10} more tiles)")
 
 # ============================================================================
@@ -169,34 +234,30 @@ print("\n[PART 4] Creating rsync download pattern...")
 
 rsync_pattern_file = '../outputs/rsync_include_pattern_lod1_only.txt'
 
-with open(rsync_pattern_file, 'w') as f:
-    f.write("# rsync include pattern for GlobalBuildingAtlas\n")
-    f.write("# LoD1 building models ONLY\n")
-    f.write(f"# Total tiles: {len(sorted_tiles)}\n\n")
-
-    f.write("# Include directory structure\n")
-    f.write("+ LoD1/\n")
-    f.write("+ LoD1/northamerica/\n")
-    f.write("\n")
-
-    f.write("# Include specific LoD1 tile files\n")
-    for tile in sorted_tiles:
-        filename = tile_mapping[tile]
-        f.write(f"+ LoD1/northamerica/{filename}.geojson\n")
-
-    f.write("\n# Exclude everything else\n")
-    f.write("- *\n")
+lines = [
+    "# rsync include pattern for GlobalBuildingAtlas",
+    "# LoD1 building models ONLY",
+    f"# Total tiles: {len(sorted_tiles)}",
+    "",
+    "# Include directory structure",
+    "+ LoD1/",
+    "+ LoD1/northamerica/",
+    "",
+    "# Include specific LoD1 tile files",
+]
+lines.extend(concat_strings("+ LoD1/northamerica/", tile_filenames, ".geojson").tolist())
+lines.extend(["", "# Exclude everything else", "- *"])
+with open(rsync_pattern_file, 'w', buffering=OUTPUT_BUFFER_SIZE) as f:
+    f.write("\n".join(lines) + "\n")
 
 print(f"rsync pattern saved to: {rsync_pattern_file}")
 
 # Save tile mapping reference
 mapping_file = '../outputs/tile_to_filename_mapping.txt'
-with open(mapping_file, 'w') as f:
-    f.write("Tile Name -> Server Filename Mapping\n")
-    f.write("=" * 60 + "\n\n")
-    for tile in sorted_tiles:
-        filename = tile_mapping[tile]
-        f.write(f"{tile:15s} -> {filename}.geojson\n")
+lines = ["Tile Name -> Server Filename Mapping", "=" * 60, ""]
+lines.extend(concat_strings(np.char.mod('%-15s', tile_names), " -> ", tile_filenames, ".geojson").tolist())
+with open(mapping_file, 'w', buffering=OUTPUT_BUFFER_SIZE) as f:
+    f.write("\n".join(lines) + "\n")
 
 print(f"Tile mapping saved to: {mapping_file}")
 
@@ -206,14 +267,14 @@ print(f"Tile mapping saved to: {mapping_file}")
 
 print("\n[PART 5] Estimating download size...")
 
-major_urban_tiles = [
+major_urban_tiles = frozenset([
     'N45_W075',  # Ottawa/Montreal: ~7.6 GB
     'N40_W075',  # NYC/Philadelphia: ~6.5 GB
     'N40_W080',  # Pittsburgh/Cleveland: ~5.3 GB
     'N45_W080',  # Toronto: ~5.8 GB
     'N45_W085',  # Detroit/Chicago: ~5.7 GB
     'N40_W085',  # Indianapolis: ~5.0 GB
-]
+])
 
 urban_in_list = [t for t in sorted_tiles if t in major_urban_tiles]
 other_count = len(sorted_tiles) - len(urban_in_list)
@@ -266,41 +327,51 @@ FTP_HOST = 'dataserv.ub.tum.de'
 FTP_USER = 'm1782307'
 FTP_PASS = 'm1782307'
 
+
+def explore_ftp(host, user, pw):
+    """
+    List the FTP root in one session -> (current directory, listing lines)
+    Uses MLSD (machine-readable entries) and falls back to LIST on servers without it
+    """
+    with FTP(host, timeout=30) as ftp:
+        ftp.login(user, pw)
+        print("✓ Connected successfully!\n")
+
+        cwd = ftp.pwd()
+        try:
+            entries = [f"{facts.get('type', '?'):5s} {facts.get('size', ''):>12s}  {name}"
+                       for name, facts in ftp.mlsd(facts=['type', 'size'])]
+        except error_perm:
+            entries = []
+            ftp.retrlines('LIST', entries.append)
+    return cwd, entries
+
+
 print("Exploring FTP Server Structure...\n")
 
 try:
-    ftp = FTP(FTP_HOST, timeout=30)
-    ftp.login(FTP_USER, FTP_PASS)
-
-    print("✓ Connected successfully!\n")
+    cwd, files = explore_ftp(FTP_HOST, FTP_USER, FTP_PASS)
 
     # Get current directory
-    print(f"Current directory: {ftp.pwd()}")
+    print(f"Current directory: {cwd}")
 
     # List root directory
     print("\n--- Root Directory Contents ---")
-    files = []
-    ftp.retrlines('LIST', files.append)
-
-    for item in files:
-        print(item)
+    print("\n".join(files))
 
     # Save to file
-    with open('outputs/ftp_structure.txt', 'w') as f:
-        f.write("FTP Server Structure\n")
-        f.write("=" * 60 + "\n\n")
-        f.write(f"Current directory: {ftp.pwd()}\n\n")
-        for item in files:
-            f.write(f"{item}\n")
-
-    print("\n\nStructure saved to: ftp_structure.txt")
-    print("\nPlease check this file to understand how files are organized.")
+    ftp_structure_file = '../outputs/ftp_structure.txt'
+    lines = ["FTP Server Structure", "=" * 60, "", f"Current directory: {cwd}", ""]
+    lines.extend(files)
+    with open(ftp_structure_file, 'w', buffering=OUTPUT_BUFFER_SIZE) as f:
+        f.write("\n".join(lines) + "\n")
 
-    ftp.quit()
+    print(f"\n\nStructure saved to: {ftp_structure_file}")
+    print("\nPlease check this file to understand how files are organized.")
 
 except Exception as e:
     print(f"Error: {e}")
     print("\nThis suggests:")
     print("1. FTP might be blocked by firewall")
     print("2. Credentials might be incorrect")
-    print("3. Server might not allow FTP connections")
\ No newline at end of file
+    print("3. Server might not allow FTP connections")
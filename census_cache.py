@@ -0,0 +1,15 @@
+"""
+GeoParquet copy of a census-blocks-with-schools GeoPackage, shared by Canada.py and United States.py
+
+The copy sits next to the GPKG (same name, .parquet suffix). Downstream scripts read it
+instead of re-parsing the GPKG, but only while it is at least as new as the GPKG.
+"""
+
+from pathlib import Path
+
+
+def write_census_parquet(gdf, gpkg_path):
+    """Write gdf as a single GeoParquet file next to gpkg_path -> path written"""
+    parquet_path = Path(gpkg_path).with_suffix('.parquet')
+    gdf.to_parquet(parquet_path, index=False)
+    return parquet_path